@@ -1,12 +1,23 @@
+import heapq
+import json
+import math
 import os
+import queue
 import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import librosa
+import numpy as np
 import soundfile as sf
 import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
 from speechbrain.pretrained import EncoderClassifier
-from torch.multiprocessing import Manager
 from torch.multiprocessing import Process
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 from torchaudio.transforms import Resample
 from tqdm import tqdm
@@ -31,10 +42,11 @@ class CodecAlignerDataset(Dataset):
                  phone_input=False,
                  allow_unknown_symbols=False,
                  gpu_count=1,
-                 rank=0):
+                 rank=0,
+                 embedding_batch_size=32):
         self.gpu_count = gpu_count
         self.rank = rank
-        if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
+        if not aligner_cache_exists(cache_dir) or rebuild_cache:
             self._build_dataset_cache(path_to_transcript_dict=path_to_transcript_dict,
                                       cache_dir=cache_dir,
                                       lang=lang,
@@ -46,22 +58,35 @@ class CodecAlignerDataset(Dataset):
                                       phone_input=phone_input,
                                       allow_unknown_symbols=allow_unknown_symbols,
                                       gpu_count=gpu_count,
-                                      rank=rank)
+                                      rank=rank,
+                                      embedding_batch_size=embedding_batch_size)
         self.lang = lang
         self.device = device
         self.cache_dir = cache_dir
-        self.tf = ArticulatoryCombinedTextFrontend(language=self.lang)
-        cache = torch.load(os.path.join(self.cache_dir, "aligner_train_cache.pt"), map_location='cpu')
-        self.speaker_embeddings = cache[2]
-        self.datapoints = cache[0]
+        cache = load_aligner_cache(self.cache_dir)
+        # everything is stored in a few packed tensors, a datapoint is just a slice of them
+        self.speech = cache["speech"]
+        self.speech_offsets = cache["speech_offsets"]
+        self.speaker_embeddings = cache["speaker_embeddings"]
+        if "tokens" not in cache:
+            # caches from before the token sequences were stored. We compute them once and save them along with the rest of the cache, so the next load has them.
+            print("converting text to token sequences...")
+            tf = ArticulatoryCombinedTextFrontend(language=self.lang)
+            token_sequences = [tf.text_vectors_to_id_sequence(text_vector=cache["text"][cache["text_offsets"][index]:cache["text_offsets"][index + 1]]) for index in tqdm(range(len(self.speaker_embeddings)))]
+            cache["tokens"] = torch.LongTensor([token for token_sequence in token_sequences for token in token_sequence])
+            cache["token_offsets"] = _lengths_to_offsets([len(token_sequence) for token_sequence in token_sequences])
+            if self.rank == 0:
+                save_aligner_cache(cache, self.cache_dir)  # with multiple GPUs, only one of them writes
+        self.tokens = cache["tokens"]
+        self.token_offsets = cache["token_offsets"]
+        self.first_datapoint = 0
+        self.datapoint_count = len(self.speaker_embeddings)
         if self.gpu_count > 1:
-            # we only keep a chunk of the dataset in memory to avoid redundancy. Which chunk, we figure out using the rank.
-            while len(self.datapoints) % self.gpu_count != 0:
-                self.datapoints.pop(-1)  # a bit unfortunate, but if you're using multiple GPUs, you probably have a ton of datapoints anyway.
-            chunksize = int(len(self.datapoints) / self.gpu_count)
-            self.datapoints = self.datapoints[chunksize * self.rank:chunksize * (self.rank + 1)]
-            self.speaker_embeddings = self.speaker_embeddings[chunksize * self.rank:chunksize * (self.rank + 1)]
-        print(f"Loaded an Aligner dataset with {len(self.datapoints)} datapoints from {cache_dir}.")
+            # we only use a chunk of the dataset to avoid redundancy. Which chunk, we figure out using the rank.
+            # If the datapoints can't be split evenly, the last few are dropped. A bit unfortunate, but if you're using multiple GPUs, you probably have a ton of datapoints anyway.
+            self.datapoint_count = self.datapoint_count // self.gpu_count
+            self.first_datapoint = self.datapoint_count * self.rank
+        print(f"Loaded an Aligner dataset with {len(self)} datapoints from {cache_dir}.")
 
     def _build_dataset_cache(self,
                              path_to_transcript_dict,
@@ -75,7 +100,8 @@ class CodecAlignerDataset(Dataset):
                              phone_input=False,
                              allow_unknown_symbols=False,
                              gpu_count=1,
-                             rank=0
+                             rank=0,
+                             embedding_batch_size=32
                              ):
         if gpu_count != 1:
             import sys
@@ -84,83 +110,180 @@ class CodecAlignerDataset(Dataset):
         os.makedirs(cache_dir, exist_ok=True)
         if type(path_to_transcript_dict) != dict:
             path_to_transcript_dict = path_to_transcript_dict()  # in this case we passed a function instead of the dict, so that the function isn't executed if not necessary.
-        torch.multiprocessing.set_start_method('spawn', force=True)
-        resource_manager = Manager()
-        self.path_to_transcript_dict = resource_manager.dict(path_to_transcript_dict)
-        key_list = list(self.path_to_transcript_dict.keys())
+        if "forkserver" in torch.multiprocessing.get_all_start_methods():
+            # the processes are forked from a server that has imported everything once already, rather than each importing the whole stack again by itself
+            torch.multiprocessing.set_forkserver_preload([__name__])
+            torch.multiprocessing.set_start_method('forkserver', force=True)
+        else:
+            torch.multiprocessing.set_start_method('spawn', force=True)
+        key_list = list(path_to_transcript_dict.keys())
         with open(os.path.join(cache_dir, "files_used.txt"), encoding='utf8', mode="w") as files_used_note:
             files_used_note.write(str(key_list))
-        fisher_yates_shuffle(key_list)
+        random.shuffle(key_list)
         # build cache
         print("... building dataset cache ...")
-        self.result_pool = resource_manager.list()
+        result_queue = torch.multiprocessing.Queue()
+        results_received = torch.multiprocessing.Event()
         # make processes
-        key_splits = list()
         process_list = list()
-        for i in range(loading_processes):
-            key_splits.append(
-                key_list[i * len(key_list) // loading_processes:(i + 1) * len(key_list) // loading_processes])
-        for key_split in key_splits:
+        key_splits, durations = _split_by_duration(key_list, loading_processes, min_len_in_seconds, max_len_in_seconds)
+        for split_index, key_split in enumerate(key_splits):
+            if len(key_split) == 0:
+                continue
             process_list.append(
                 Process(target=self._cache_builder_process,
-                        args=(key_split,
+                        args=({path: path_to_transcript_dict[path] for path in key_split},  # each process only gets the transcripts it needs, they are passed once at startup
+                              {path: durations[path] for path in key_split},  # the headers are read already, so the processes don't need to read them again
                               lang,
                               min_len_in_seconds,
                               max_len_in_seconds,
                               verbose,
                               device,
                               phone_input,
-                              allow_unknown_symbols),
+                              allow_unknown_symbols,
+                              os.path.join(cache_dir, f"aligner_cache_chunk_{split_index}.pt"),
+                              result_queue,
+                              results_received),
                         daemon=True))
             process_list[-1].start()
-        for process in process_list:
-            process.join()
         print("pooling results...")
         pooled_datapoints = list()
-        for chunk in self.result_pool:
-            for datapoint in chunk:
-                pooled_datapoints.append(datapoint)  # unpack into a joint list
+        chunks_received = 0
+        failed_processes = 0
+        # a process that has exited before we set results_received died without delivering its results, e.g. because it was killed
+        while chunks_received + sum(process.exitcode is not None for process in process_list) < len(process_list):
+            try:
+                chunk_path = result_queue.get(timeout=10)
+            except queue.Empty:
+                continue
+            chunks_received += 1
+            if chunk_path is None:
+                failed_processes += 1  # the process already printed what went wrong
+                continue
+            pooled_datapoints.extend(_unpack_datapoints(torch.load(chunk_path, map_location='cpu')))  # unpack into a joint list
+            os.remove(chunk_path)
+        results_received.set()  # the processes wait for this, so a process that exits early can be told apart from one that is done
+        for process in process_list:
+            process.join()
+        failed_processes += len(process_list) - chunks_received
+        if failed_processes > 0:
+            raise RuntimeError(f"{failed_processes} of {len(process_list)} cache building processes failed, so the cache would be incomplete and is not saved.")
+        # the splits are filled longest first, so the chunks come back roughly sorted by duration. Shuffling keeps the
+        # contiguous ranges of datapoints that the GPUs take during training from ending up with very different lengths.
+        random.shuffle(pooled_datapoints)
         self.result_pool = pooled_datapoints
         del pooled_datapoints
-        print("converting text to tensors...")
-        text_tensors = [torch.ShortTensor(x[0]) for x in self.result_pool]  # turn everything back to tensors (had to turn it to np arrays to avoid multiprocessing issues)
-        print("converting speech to tensors...")
-        speech_tensors = [torch.ShortTensor(x[1]) for x in self.result_pool]
-        print("converting waves to tensors...")
-        norm_waves = [torch.Tensor(x[2]) for x in self.result_pool]
-        print("unpacking file list...")
+        print("unpacking datapoints...")
+        self.datapoints = [(x[0], x[1]) for x in self.result_pool]
+        norm_waves = [x[2] for x in self.result_pool]
         filepaths = [x[3] for x in self.result_pool]
         del self.result_pool
-        self.datapoints = list(zip(text_tensors, speech_tensors))
-        del text_tensors
-        del speech_tensors
         print("done!")
 
         # add speaker embeddings
-        self.speaker_embeddings = list()
         speaker_embedding_func_ecapa = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
                                                                       run_opts={"device": str(device)},
                                                                       savedir=os.path.join(MODELS_DIR, "Embedding", "speechbrain_speaker_embedding_ecapa"))
+        self.speaker_embeddings = [None] * len(norm_waves)
+        # sorting by length keeps the padding within each batch small
+        sorted_indexes = sorted(range(len(norm_waves)), key=lambda index: len(norm_waves[index]))
+        batch_indexes = [sorted_indexes[batch_start:batch_start + embedding_batch_size] for batch_start in range(0, len(sorted_indexes), embedding_batch_size)]
+        device_type = torch.device(device).type
+        # the loader pads and pins the next batches while the GPU is busy with the current one. Padding is cheap, so a single worker that is
+        # at most two batches ahead is enough, and it keeps the batches that are staged in shared memory well below small shm limits.
+        # We fork the worker where we can, so it shares the waves with this process instead of receiving a copy.
+        wave_loader = DataLoader(dataset=_WaveDataset(norm_waves),
+                                 batch_sampler=batch_indexes,
+                                 num_workers=1,
+                                 pin_memory=device_type == "cuda",
+                                 prefetch_factor=2,
+                                 collate_fn=_pad_waves,
+                                 multiprocessing_context="fork" if "fork" in torch.multiprocessing.get_all_start_methods() else None)
+        # we run the same steps as encode_batch, but call the modules directly instead of going through the pretrained interface for every batch
+        compute_features = speaker_embedding_func_ecapa.mods.compute_features
+        mean_var_norm = speaker_embedding_func_ecapa.mods.mean_var_norm
+        embedding_model = speaker_embedding_func_ecapa.mods.embedding_model
         with torch.inference_mode():
-            for wave in tqdm(norm_waves):
-                self.speaker_embeddings.append(speaker_embedding_func_ecapa.encode_batch(wavs=wave.to(device).unsqueeze(0)).squeeze().cpu())
+            for indexes, (batch, relative_lens) in zip(batch_indexes, tqdm(wave_loader)):
+                relative_lens = relative_lens.to(device, non_blocking=True)
+                # the summed power spectra in the filterbank features can overflow half precision, so only the backbone runs under autocast
+                features = mean_var_norm(compute_features(batch.to(device, non_blocking=True).float()), relative_lens)
+                # the ECAPA backbone is convolutional and holds up well in half precision, the embeddings are stored in full precision again
+                with torch.autocast(device_type=device_type, dtype=torch.float16, enabled=device_type == "cuda"):
+                    embeddings = embedding_model(features, relative_lens)
+                embeddings = embeddings.squeeze(1).float().cpu()
+                for embedding, index in zip(embeddings, indexes):
+                    self.speaker_embeddings[index] = embedding
+
+        # the token sequences only depend on the text, so we compute them once here instead of every time a datapoint is loaded
+        print("converting text to token sequences...")
+        tf = ArticulatoryCombinedTextFrontend(language=lang)
+        token_sequences = [torch.LongTensor(tf.text_vectors_to_id_sequence(text_vector=text)) for text, _ in tqdm(self.datapoints)]
 
         # save to cache
         if len(self.datapoints) == 0:
             raise RuntimeError  # something went wrong and there are no datapoints
-        torch.save((self.datapoints, None, self.speaker_embeddings, filepaths),
-                   os.path.join(cache_dir, "aligner_train_cache.pt"))
+        save_aligner_cache(pack_aligner_cache(self.datapoints, self.speaker_embeddings, filepaths, token_sequences), cache_dir)
 
     def _cache_builder_process(self,
-                               path_list,
+                               path_to_transcript_dict,
+                               durations,
                                lang,
                                min_len,
                                max_len,
                                verbose,
                                device,
                                phone_input,
-                               allow_unknown_symbols):
+                               allow_unknown_symbols,
+                               chunk_path,
+                               result_queue,
+                               results_received):
+        chunk_saved = False
+        try:
+            # the chunk is packed into a few contiguous tensors and written to the cache directory. Passing it through the queue would put
+            # the entire corpus into shared memory, which is often much smaller than the corpus, so only the path goes through the queue.
+            torch.save(_pack_datapoints(self._build_cache_chunk(path_to_transcript_dict,
+                                                                durations,
+                                                                lang,
+                                                                min_len,
+                                                                max_len,
+                                                                verbose,
+                                                                device,
+                                                                phone_input,
+                                                                allow_unknown_symbols)), chunk_path)
+            chunk_saved = True
+        finally:
+            # we report back even if something went wrong in here, otherwise the pooling would keep waiting for this process
+            result_queue.put(chunk_path if chunk_saved else None)
+            results_received.wait()
+
+    def _build_cache_chunk(self,
+                           path_to_transcript_dict,
+                           durations,
+                           lang,
+                           min_len,
+                           max_len,
+                           verbose,
+                           device,
+                           phone_input,
+                           allow_unknown_symbols,
+                           codec_batch_size=16):
         process_internal_dataset_chunk = list()
+        path_list = list()
+        for path in path_to_transcript_dict:
+            if path_to_transcript_dict[path].strip() == "":
+                continue
+            # the durations come from the headers, so we don't decode audios that we would throw away anyway
+            if durations[path] is None:
+                print(f"Problem with an audio file: {path}")
+                continue
+            if not (min_len <= durations[path] <= max_len):
+                if verbose:
+                    print(f"Excluding {path} because of its duration of {round(durations[path], 2)} seconds.")
+                continue
+            path_list.append(path)
+        if len(path_list) == 0:
+            return process_internal_dataset_chunk  # no usable audio in this split
         torch.hub._validate_not_a_forked_repo = lambda a, b, c: True  # torch 1.9 has a bug in the hub loading, this is a workaround
         # careful: assumes 16kHz or 8kHz audio
         silero_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
@@ -178,32 +301,73 @@ class CodecAlignerDataset(Dataset):
         silero_model = silero_model.to(device)
         silence = torch.zeros([16000 // 4], device=device)
         tf = ArticulatoryCombinedTextFrontend(language=lang)
-        _, sr = sf.read(path_list[0])
-        assumed_sr = sr
+
+        @lru_cache(maxsize=100000)
+        def text_to_features(transcript, handle_missing):
+            # transcripts tend to repeat (prompts, tags, ...), so we only process each distinct one once
+            return tf.string_to_tensor(transcript, handle_missing=handle_missing, input_phonemes=phone_input).squeeze(0).cpu().numpy()
+
+        assumed_sr = sf.info(path_list[0]).samplerate
         ap = CodecAudioPreprocessor(input_sr=assumed_sr, device=device)
         resample = Resample(orig_freq=assumed_sr, new_freq=16000).to(device)
 
-        for path in tqdm(path_list):
-            if self.path_to_transcript_dict[path].strip() == "":
-                continue
+        def process_audio_batch(audio_batch):
+            # resample and ap are looked up when this is called, so it always uses the ones for the current sampling rate
+            return self._process_audio_batch(audio_batch, resample, ap, silero_model, get_speech_timestamps, silence, text_to_features, min_len, max_len, verbose, allow_unknown_symbols, device)
 
-            try:
-                wave, sr = sf.read(path)
-            except:
-                print(f"Problem with an audio file: {path}")
+        # the audios are decoded in background threads, which stay up to a full batch ahead, so the next batch is read while the GPU works on the current one
+        audio_reader = ThreadPoolExecutor(max_workers=4)
+        pending_audios = deque(audio_reader.submit(_read_audio, path) for path in path_list[:codec_batch_size])
+        audio_batch = list()
+        for index, path in enumerate(tqdm(path_list)):
+            transcript = path_to_transcript_dict[path]
+            audio = pending_audios.popleft().result()
+            if index + codec_batch_size < len(path_list):
+                pending_audios.append(audio_reader.submit(_read_audio, path_list[index + codec_batch_size]))
+            if audio is None:
                 continue
-
-            wave = librosa.to_mono(wave)
+            wave, sr = audio
 
             if sr != assumed_sr:
+                # the audios that are already collected still need the previous sampling rate
+                process_internal_dataset_chunk.extend(process_audio_batch(audio_batch))
+                audio_batch = list()
                 assumed_sr = sr
                 ap = CodecAudioPreprocessor(input_sr=assumed_sr, device=device)
                 resample = Resample(orig_freq=assumed_sr, new_freq=16000).to(device)
                 print(f"{path} has a different sampling rate --> adapting the codec processor")
 
-            try:
-                norm_wave = resample(torch.tensor(wave).float().to(device))
-            except ValueError:
+            audio_batch.append((path, transcript, wave))
+            if len(audio_batch) == codec_batch_size:
+                process_internal_dataset_chunk.extend(process_audio_batch(audio_batch))
+                audio_batch = list()
+        process_internal_dataset_chunk.extend(process_audio_batch(audio_batch))
+        audio_reader.shutdown()
+        return process_internal_dataset_chunk
+
+    def _process_audio_batch(self, audio_batch, resample, ap, silero_model, get_speech_timestamps, silence, text_to_features, min_len, max_len, verbose, allow_unknown_symbols, device):
+        """
+        Takes a list of (path, transcript, wave) tuples that share a sampling rate and runs the resampling and the codec on all of them at once, which is a lot
+        cheaper on the GPU than one small call per audio. The silence removal and the text processing still happen for each audio individually in between.
+        """
+        if len(audio_batch) == 0:
+            return list()
+        waves = [torch.from_numpy(wave) for _, _, wave in audio_batch]  # the audios are read as float32 already, so this doesn't copy
+        try:
+            resampled_batch = resample(pad_sequence(waves, batch_first=True).to(device))
+            norm_waves = [resampled_wave[:math.ceil(len(wave) * resample.new_freq / resample.orig_freq)] for resampled_wave, wave in zip(resampled_batch, waves)]
+        except ValueError:
+            # some audio in the batch can't be resampled, so we try them one by one and skip the problematic ones
+            norm_waves = list()
+            for wave in waves:
+                try:
+                    norm_waves.append(resample(wave.to(device)))
+                except ValueError:
+                    norm_waves.append(None)
+
+        prepared_datapoints = list()
+        for (path, transcript, _), norm_wave in zip(audio_batch, norm_waves):
+            if norm_wave is None:
                 continue
             dur_in_seconds = len(norm_wave) / 16000
             if not (min_len <= dur_in_seconds <= max_len):
@@ -222,15 +386,14 @@ class CodecAlignerDataset(Dataset):
             wave = torch.cat([silence, result, silence])
 
             # raw audio preprocessing is done
-            transcript = self.path_to_transcript_dict[path]
 
             try:
                 try:
-                    cached_text = tf.string_to_tensor(transcript, handle_missing=False, input_phonemes=phone_input).squeeze(0).cpu().numpy()
+                    cached_text = text_to_features(transcript, handle_missing=False)
                 except KeyError:
-                    cached_text = tf.string_to_tensor(transcript, handle_missing=True, input_phonemes=phone_input).squeeze(0).cpu().numpy()
                     if not allow_unknown_symbols:
-                        continue  # we skip sentences with unknown symbols
+                        continue  # we skip sentences with unknown symbols, so there is no need to process them again
+                    cached_text = text_to_features(transcript, handle_missing=True)
             except ValueError:
                 # this can happen for Mandarin Chinese, when the syllabification of pinyin doesn't work. In that case, we just skip the sample.
                 continue
@@ -238,22 +401,27 @@ class CodecAlignerDataset(Dataset):
                 # this can happen for Mandarin Chinese, when the syllabification of pinyin doesn't work. In that case, we just skip the sample.
                 continue
 
-            cached_speech = ap.audio_to_codebook_indexes(audio=wave, current_sampling_rate=16000).transpose(0, 1).cpu().numpy()
-            process_internal_dataset_chunk.append([cached_text,
-                                                   cached_speech,
-                                                   result.cpu().detach().numpy(),
-                                                   path])
-        self.result_pool.append(process_internal_dataset_chunk)
+            prepared_datapoints.append((cached_text, wave, result, path))
+
+        if len(prepared_datapoints) == 0:
+            return list()
+        # the convolutional encoder of the codec holds up well in bfloat16, the quantization into discrete codes happens in full precision.
+        # GPUs from before Ampere don't support bfloat16, those just run the encoder in full precision.
+        device_type = torch.device(device).type
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=device_type == "cuda" and torch.cuda.is_bf16_supported()):
+            codes = ap.audio_batch_to_codebook_indexes(audios=[wave for _, wave, _, _ in prepared_datapoints], current_sampling_rate=16000, time_major=True)
+        # the indexes are small enough for int16, converting them before they leave the GPU halves the transfer compared to the int64 the codec produces
+        return [[cached_text,
+                 cached_speech.short().cpu().numpy(),
+                 result.cpu().detach().numpy(),
+                 path] for (cached_text, _, result, path), cached_speech in zip(prepared_datapoints, codes)]
 
     def __getitem__(self, index):
-        text_vector = self.datapoints[index][0]
-        tokens = self.tf.text_vectors_to_id_sequence(text_vector=text_vector)
-        tokens = torch.LongTensor(tokens)
+        index = self.first_datapoint + index
+        tokens = self.tokens[self.token_offsets[index]:self.token_offsets[index + 1]]
         token_len = torch.LongTensor([len(tokens)])
 
-        codes = self.datapoints[index][1]
-        if codes.size()[0] != 24:  # no clue why this is sometimes the case
-            codes = codes.transpose(0, 1)
+        codes = self.speech[self.speech_offsets[index]:self.speech_offsets[index + 1]].transpose(0, 1)  # the packed codes are stored frames first
 
         return tokens, \
                token_len, \
@@ -262,10 +430,143 @@ class CodecAlignerDataset(Dataset):
                self.speaker_embeddings[index]
 
     def __len__(self):
-        return len(self.datapoints)
+        return self.datapoint_count
+
+
+def pack_aligner_cache(datapoints, speaker_embeddings, filepaths, token_sequences=None):
+    """
+    packs the (text, speech) datapoints of the aligner cache into one concatenated tensor per field plus the offsets where each datapoint starts,
+    so the cache can be saved and loaded as a handful of big tensors instead of a huge list of tiny ones
+    """
+    cache = {"text"              : torch.cat([datapoint[0] for datapoint in datapoints]),
+             "text_offsets"      : _lengths_to_offsets([len(datapoint[0]) for datapoint in datapoints]),
+             "speech"            : torch.cat([datapoint[1] for datapoint in datapoints]),
+             "speech_offsets"    : _lengths_to_offsets([len(datapoint[1]) for datapoint in datapoints]),
+             "speaker_embeddings": torch.stack(list(speaker_embeddings)),
+             "filepaths"         : filepaths}
+    if token_sequences is not None:
+        cache["tokens"] = torch.cat(token_sequences)
+        cache["token_offsets"] = _lengths_to_offsets([len(token_sequence) for token_sequence in token_sequences])
+    return cache
+
+
+def save_aligner_cache(cache, cache_dir):
+    # safetensors only stores tensors, so the file paths go into a file next to it. Putting them into the header would fail to load for large corpora.
+    # The paths are written first, so an existing tensor file always comes with its paths.
+    with open(os.path.join(cache_dir, "aligner_train_cache_filepaths.json"), encoding='utf8', mode="w") as filepaths_file:
+        json.dump(cache["filepaths"], filepaths_file)
+    save_file({key: cache[key] for key in cache if key != "filepaths"},
+              os.path.join(cache_dir, "aligner_train_cache.safetensors"))
+
+
+def load_aligner_cache(cache_dir):
+    if os.path.exists(os.path.join(cache_dir, "aligner_train_cache.safetensors")):
+        with safe_open(os.path.join(cache_dir, "aligner_train_cache.safetensors"), framework="pt", device="cpu") as cache_file:
+            cache = {key: cache_file.get_tensor(key) for key in cache_file.keys()}
+        with open(os.path.join(cache_dir, "aligner_train_cache_filepaths.json"), encoding='utf8', mode="r") as filepaths_file:
+            cache["filepaths"] = json.load(filepaths_file)
+        return cache
+    # caches from before the safetensors format
+    cache = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu', mmap=True)
+    if type(cache) == tuple:
+        # cache from before the packed format
+        cache = pack_aligner_cache(cache[0], cache[2], cache[3])
+    return cache
+
+
+def aligner_cache_exists(cache_dir):
+    return os.path.exists(os.path.join(cache_dir, "aligner_train_cache.safetensors")) or os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt"))
+
+
+def unpack_aligner_cache(cache):
+    """
+    returns the list of (text, speech) datapoints, the list of speaker embeddings and the file paths of a packed aligner cache.
+    Everything is cloned out of the packed tensors, so saving some datapoints later doesn't drag the entire packed storage along.
+    """
+    datapoints = [(cache["text"][cache["text_offsets"][index]:cache["text_offsets"][index + 1]].clone(),
+                   cache["speech"][cache["speech_offsets"][index]:cache["speech_offsets"][index + 1]].clone()) for index in range(len(cache["filepaths"]))]
+    speaker_embeddings = [speaker_embedding.clone() for speaker_embedding in cache["speaker_embeddings"]]
+    return datapoints, speaker_embeddings, cache["filepaths"]
+
+
+def _split_by_duration(paths, split_count, min_len, max_len):
+    """
+    distributes the audio files into splits of about the same total duration, so no single process has to work much longer than the others.
+    Longest files first, each one goes to the split that has the least audio so far.
+    Returns the splits and the duration of every file according to its header, or None if the header can't be read.
+    """
+    # reading the headers is mostly waiting for the disk, so we read many of them at once
+    with ThreadPoolExecutor(max_workers=16) as header_reader:
+        durations = dict(zip(paths, header_reader.map(_read_duration, paths)))
+    # files that are unreadable or outside the length limits are rejected by the processes right away, so they cost next to nothing
+    weights = [durations[path] if durations[path] is not None and min_len <= durations[path] <= max_len else 0.0 for path in paths]
+    splits = [list() for _ in range(split_count)]
+    split_durations = [(0.0, split_index) for split_index in range(split_count)]
+    for path_index in sorted(range(len(paths)), key=lambda index: weights[index], reverse=True):
+        total_duration, split_index = heapq.heappop(split_durations)
+        splits[split_index].append(paths[path_index])
+        heapq.heappush(split_durations, (total_duration + weights[path_index], split_index))
+    return splits, durations
+
+
+def _lengths_to_offsets(lengths):
+    return torch.cumsum(torch.LongTensor([0] + lengths), dim=0)
+
+
+def _read_duration(path):
+    try:
+        info = sf.info(path)
+        return info.frames / info.samplerate
+    except:
+        return None
+
+
+def _read_audio(path):
+    try:
+        wave, sr = sf.read(path, dtype="float32")
+    except:
+        print(f"Problem with an audio file: {path}")
+        return None
+    return librosa.to_mono(wave), sr
+
+
+def _pack_datapoints(datapoints):
+    if len(datapoints) == 0:
+        return None
+    return {"text"        : torch.from_numpy(np.concatenate([datapoint[0] for datapoint in datapoints])),
+            "text_lens"   : [len(datapoint[0]) for datapoint in datapoints],
+            "speech"      : torch.from_numpy(np.concatenate([datapoint[1] for datapoint in datapoints])),
+            "speech_lens" : [len(datapoint[1]) for datapoint in datapoints],
+            "waves"       : torch.from_numpy(np.concatenate([datapoint[2] for datapoint in datapoints])),
+            "wave_lens"   : [len(datapoint[2]) for datapoint in datapoints],
+            "paths"       : [datapoint[3] for datapoint in datapoints]}
+
+
+def _unpack_datapoints(packed_datapoints):
+    if packed_datapoints is None:
+        return list()
+    # the dtype conversion happens once for the whole chunk, the datapoints are views into the converted tensors
+    return [[text, speech, wave, path] for text, speech, wave, path in
+            zip(torch.split(packed_datapoints["text"].short(), packed_datapoints["text_lens"]),
+                torch.split(packed_datapoints["speech"].short(), packed_datapoints["speech_lens"]),
+                torch.split(packed_datapoints["waves"].float(), packed_datapoints["wave_lens"]),
+                packed_datapoints["paths"])]
+
+
+class _WaveDataset(Dataset):
+
+    def __init__(self, waves):
+        self.waves = waves
+
+    def __getitem__(self, index):
+        return self.waves[index]
+
+    def __len__(self):
+        return len(self.waves)
 
 
-def fisher_yates_shuffle(lst):
-    for i in range(len(lst) - 1, 0, -1):
-        j = random.randint(0, i)
-        lst[i], lst[j] = lst[j], lst[i]
+def _pad_waves(batch):
+    # waves, lengths relative to the longest wave in the batch
+    max_len = max(len(wave) for wave in batch)
+    return (pad_sequence(batch, batch_first=True),
+            torch.tensor([len(wave) / max_len for wave in batch]))
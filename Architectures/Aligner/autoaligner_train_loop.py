@@ -87,6 +87,7 @@ def train_loop(train_dataset,
                               num_workers=0,  # unfortunately necessary for big data due to mmap errors
                               batch_sampler=batch_sampler_train,
                               prefetch_factor=None,
+                              pin_memory=torch.device(device).type == "cuda",  # the batches land in pinned memory, so they can be copied to the GPU asynchronously
                               collate_fn=collate_and_pad)
 
     step_counter = 0
@@ -114,16 +115,16 @@ def train_loop(train_dataset,
         asr_model.train()
         tiny_tts.train()
         for batch in tqdm(train_loader):
-            tokens = batch[0].to(device)
-            tokens_len = batch[1].to(device)
-            speaker_embeddings = batch[4].to(device)
+            tokens = batch[0].to(device, non_blocking=True)
+            tokens_len = batch[1].to(device, non_blocking=True)
+            speaker_embeddings = batch[4].to(device, non_blocking=True)
 
             mels = list()
             mel_lengths = list()
             for datapoint in batch[2]:
                 with torch.inference_mode():
                     # extremely unfortunate that we have to do this over here, but multiprocessing and this don't go together well
-                    speech = ap.indexes_to_audio(datapoint.int().to(device))
+                    speech = ap.indexes_to_audio(datapoint.to(device, non_blocking=True).int())  # the codes come pinned, so the int16 tensor is copied asynchronously and cast on the GPU
                     mel = spectrogram_extractor.audio_to_mel_spec_tensor(speech, explicit_sampling_rate=16000).transpose(0, 1).cpu()
                 speech_len = torch.LongTensor([len(mel)])
                 mels.append(mel.clone())
@@ -7,6 +7,9 @@ from tqdm import tqdm
 
 from Architectures.Aligner.Aligner import Aligner
 from Architectures.Aligner.CodecAlignerDataset import CodecAlignerDataset
+from Architectures.Aligner.CodecAlignerDataset import aligner_cache_exists
+from Architectures.Aligner.CodecAlignerDataset import load_aligner_cache
+from Architectures.Aligner.CodecAlignerDataset import unpack_aligner_cache
 from Architectures.ToucanTTS.DurationCalculator import DurationCalculator
 from Architectures.ToucanTTS.EnergyCalculator import EnergyCalculator
 from Architectures.ToucanTTS.PitchCalculator import Parselmouth
@@ -85,7 +88,7 @@ class TTSDataset(Dataset):
             import sys
             print("Please run the feature extraction using only a single GPU. Multi-GPU is only supported for training.")
             sys.exit()
-        if not os.path.exists(os.path.join(cache_dir, "aligner_train_cache.pt")) or rebuild_cache:
+        if not aligner_cache_exists(cache_dir) or rebuild_cache:
             CodecAlignerDataset(path_to_transcript_dict=path_to_transcript_dict,
                                 cache_dir=cache_dir,
                                 lang=lang,
@@ -94,9 +97,8 @@ class TTSDataset(Dataset):
                                 max_len_in_seconds=max_len_in_seconds,
                                 rebuild_cache=rebuild_cache,
                                 device=device)
-        datapoints = torch.load(os.path.join(cache_dir, "aligner_train_cache.pt"), map_location='cpu')
         # we use the aligner dataset as basis and augment it to contain the additional information we need for tts.
-        self.dataset, _, speaker_embeddings, filepaths = datapoints
+        self.dataset, speaker_embeddings, filepaths = unpack_aligner_cache(load_aligner_cache(cache_dir))
 
         print("... building dataset cache ...")
         self.codec_wrapper = CodecAudioPreprocessor(input_sr=-1, device=device)
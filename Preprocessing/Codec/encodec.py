@@ -2,6 +2,7 @@ import math
 import random
 
 import numpy as np
+import torch
 import torch.nn as nn
 
 from Preprocessing.Codec.seanet import SEANetDecoder
@@ -48,7 +49,9 @@ class EnCodec(nn.Module):
             bw = target_bw
         if st is None:
             st = 0
-        codes = self.quantizer.encode(e, self.frame_rate, bw, st)
+        # the encoder may run under autocast, but the codebook lookup always happens in full precision, so the selected codes don't change
+        with torch.autocast(device_type=e.device.type, enabled=False):
+            codes = self.quantizer.encode(e.float(), self.frame_rate, bw, st)
         return codes
 
     def decode(self, codes):
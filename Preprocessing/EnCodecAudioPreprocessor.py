@@ -1,6 +1,8 @@
+import math
 from collections import OrderedDict
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from torchaudio.transforms import Resample
 
 from Preprocessing.Codec.encodec import EnCodec
@@ -42,6 +44,22 @@ class CodecAudioPreprocessor:
             audio = torch.tensor(audio, device=self.device, dtype=torch.float32)
         return self.model.encode(audio.float().unsqueeze(0).unsqueeze(0).to(self.device)).squeeze()
 
+    @torch.inference_mode()
+    def audio_batch_to_codebook_indexes(self, audios, current_sampling_rate, time_major=False):
+        """
+        encodes a list of audios in a single padded batch and returns a list with the codebook indexes of each audio, cut to its own length.
+        With time_major, the indexes of each audio come as frames x codebooks instead of codebooks x frames, contiguous in memory.
+        """
+        if current_sampling_rate != self.output_sr:
+            audios = [self.resample_audio(audio, current_sampling_rate) for audio in audios]
+        else:
+            audios = [torch.as_tensor(audio, dtype=torch.float32, device=self.device) for audio in audios]
+        codes = self.model.encode(pad_sequence(audios, batch_first=True).float().unsqueeze(1).to(self.device))  # codebooks x batch x frames
+        if time_major:
+            codes = codes.permute(1, 2, 0).contiguous()  # batch x frames x codebooks
+            return [codes[index, :math.ceil(len(audio) / self.model.hop_length)] for index, audio in enumerate(audios)]
+        return [codes[:, index, :math.ceil(len(audio) / self.model.hop_length)] for index, audio in enumerate(audios)]
+
     @torch.inference_mode()
     def indexes_to_audio(self, codebook_indexes):
         return self.model.decode(codebook_indexes).squeeze()
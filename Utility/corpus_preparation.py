@@ -1,6 +1,7 @@
 import torch.multiprocessing
 
 from Architectures.Aligner.CodecAlignerDataset import CodecAlignerDataset
+from Architectures.Aligner.CodecAlignerDataset import aligner_cache_exists
 from Architectures.Aligner.autoaligner_train_loop import train_loop as train_aligner
 from Architectures.ToucanTTS.TTSDataset import TTSDataset
 from Utility.path_to_transcript_dicts import *
@@ -43,7 +44,7 @@ def prepare_tts_corpus(transcript_dict,
             aligner_dir = os.path.join(corpus_dir, "Aligner")
             aligner_loc = os.path.join(corpus_dir, "Aligner", "aligner.pt")
 
-            if not os.path.exists(os.path.join(corpus_dir, "aligner_train_cache.pt")):
+            if not aligner_cache_exists(corpus_dir):
                 prepare_aligner_corpus(transcript_dict, corpus_dir=corpus_dir, lang=lang, phone_input=phone_input, device=torch.device("cuda"))
 
             if not os.path.exists(os.path.join(aligner_dir, "aligner.pt")):